@@ -1,103 +1,434 @@
-import os, sys, datetime, hashlib, pandas as pd
+import os, io, sys, json, time, queue, atexit, threading, shutil, argparse, socket, datetime, hashlib
+import logging, logging.handlers, numpy as np, pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from playwright.sync_api import sync_playwright
 
 # === CONFIG (override via env vars) ===
 URL = os.getenv("SCRAPE_URL", "https://example.com/products")
+CARD_SELECTOR = os.getenv("CARD_SELECTOR", ".product-card")
+NAME_SELECTOR = os.getenv("NAME_SELECTOR", ".product-name")
+PRICE_SELECTOR = os.getenv("PRICE_SELECTOR", ".price")
 OUTPUT_DIR = os.getenv("OUTPUT_DIR", "/tmp/artifacts")  # ephemeral local dir
 UPLOAD_TO = os.getenv("UPLOAD_TO", "none")  # "s3", "gcs", or "none"
 BUCKET_NAME = os.getenv("BUCKET_NAME", "")
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", "2"))  # extra attempts per failed upload
+ARCHIVE_FMT = os.getenv("ARCHIVE_FMT", "feather")  # "feather", "parquet", or "csv"
+ENGINE = os.getenv("DF_ENGINE", "pandas")  # "pandas" or opt-in "polars"
+FINGERPRINT_SELECTOR = os.getenv("FINGERPRINT_SELECTOR", "")  # e.g. "main"; empty = full HTML
+# session cookies: kept out of OUTPUT_DIR so they never ship with the artifacts
+STATE_DIR = os.getenv("STATE_DIR", os.path.expanduser("~/.cache/playwright-scraper"))
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 LATEST_PATH = os.path.join(OUTPUT_DIR, "latest.csv")
+STATE_PATH = os.path.join(STATE_DIR, "storage_state.json")
+PAGE_HASH_PATH = os.path.join(OUTPUT_DIR, "last_page.sha")  # fingerprint of the archived page
+SOCKET_PATH = os.getenv("SOCKET_PATH", os.path.join(OUTPUT_DIR, "scraper.sock"))
 ARCHIVE_DIR = os.path.join(OUTPUT_DIR, "archive")
+ARCHIVE_EXT = {"feather": ".feather", "parquet": ".parquet"}.get(ARCHIVE_FMT, ".csv")
+SNAPSHOT_PATH = os.path.join(ARCHIVE_DIR, f"last_snapshot{ARCHIVE_EXT}")  # previous run's frame
 os.makedirs(ARCHIVE_DIR, exist_ok=True)
 
+# Selectors are fixed per deployment, so the extractor JS and column schema are built
+# once at import instead of on every scrape
+_EXTRACT_JS = """cards => cards.map(c => {
+  const n = c.querySelector(%s); const p = c.querySelector(%s);
+  return [n ? n.innerText.trim() : '', p ? p.innerText.trim() : ''];
+})""" % (json.dumps(NAME_SELECTOR), json.dumps(PRICE_SELECTOR))
+# folded into the page fingerprint so a selector change forces a fresh extraction
+_EXTRACTOR_KEY = CARD_SELECTOR + "\0" + _EXTRACT_JS + "\0"
+# single shared schema; each engine's dtypes are derived from it
+SCHEMA = {"name": "utf8", "price": "utf8", "hash": "binary", "hash64": "uint64"}
+PD_SCHEMA = {c: {"utf8": "string[pyarrow]", "binary": "object", "uint64": "uint64"}[t]
+             for c, t in SCHEMA.items()}
+_df_prev = None  # last run's frame, reused by long-lived (--daemon) workers
+_uploads = ThreadPoolExecutor(max_workers=4)
+if ENGINE == "polars":
+    import polars as pl
+    PL_SCHEMA = {c: {"utf8": pl.Utf8, "binary": pl.Binary, "uint64": pl.UInt64}[t]
+                 for c, t in SCHEMA.items()}
+
+logger = logging.getLogger("scraper")
+_log_queue = queue.SimpleQueue()
+_listener = None
+_log_lock = threading.Lock()
+
+class _DrainFlushHandler(logging.StreamHandler):
+    # flush only once the queue is drained: bursts go out as one write, idle logs stay live
+    def flush(self):
+        if _log_queue.empty():
+            super().flush()
+
+def setup_logging():
+    # log() only enqueues; a listener thread formats and writes the records to stdout
+    global _listener
+    with _log_lock:  # log() may first run on an upload worker thread
+        if _listener is not None:
+            return
+        fmt = logging.Formatter("[%(asctime)s.%(msecs)03d] %(message)s", "%Y-%m-%dT%H:%M:%S")
+        fmt.converter = time.gmtime
+        handler = _DrainFlushHandler(sys.stdout)
+        handler.setFormatter(fmt)
+        listener = logging.handlers.QueueListener(_log_queue, handler)
+        listener.start()
+        atexit.register(listener.stop)  # drains queued records before exit
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+        _listener = listener  # set last: other threads skip setup only once it's complete
+
 def log(msg):
-    ts = datetime.datetime.utcnow().isoformat()
-    print(f"[{ts}] {msg}", flush=True)
+    if _listener is None:  # lazy, so importers calling run()/serve() directly still get output
+        setup_logging()
+    logger.info(msg)
+
+def sha256_many(payloads):
+    # hashlib is backed by OpenSSL, which already dispatches to SHA-NI when the CPU has it
+    return [hashlib.sha256(b).digest() for b in payloads]
+
+def hash_rows(names, prices):
+    # raw SHA-256 digest of each "name|price" row
+    return sha256_many([f"{n}|{p}".encode("utf-8") for n, p in zip(names, prices)])
 
 def get_hash(value: str):
-    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+    # raw 32-byte digest, half the size of hexdigest(); hex only for human-facing output.
+    # scrape_page hashes rows in bulk via sha256_many
+    return sha256_many([value.encode("utf-8")])[0]
+
+def has_data(path):
+    # one stat syscall; missing and empty files both count as absent
+    try:
+        return os.stat(path).st_size > 0
+    except FileNotFoundError:
+        return False
+
+def open_context(p):
+    browser = p.chromium.launch(headless=True)
+    state = STATE_PATH if has_data(STATE_PATH) else None
+    return browser, browser.new_context(storage_state=state)
+
+def close_context(browser, context, save_state=False):
+    if save_state:
+        os.makedirs(STATE_DIR, mode=0o700, exist_ok=True)
+        context.storage_state(path=STATE_PATH)
+    browser.close()
+
+def page_fingerprint(page):
+    # innerText of a container ignores markup/CSS churn that doesn't change content;
+    # query_selector doesn't wait, so a missing container falls back to the full HTML
+    el = page.query_selector(FINGERPRINT_SELECTOR) if FINGERPRINT_SELECTOR else None
+    if FINGERPRINT_SELECTOR and el is None:
+        log(f"Fingerprint container {FINGERPRINT_SELECTOR!r} not found; hashing full HTML")
+    text = el.inner_text() if el is not None else page.content()
+    return get_hash(_EXTRACTOR_KEY + text)
 
-def scrape_page():
-    log(f"Starting scrape of {URL}")
+def read_page_hash():
+    try:
+        with open(PAGE_HASH_PATH, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def scrape_page(page, url=URL, known_hash=None):
+    # returns (df, page_hash); df is None when page_hash matches known_hash
+    log(f"Starting scrape of {url}")
+    page.goto(url, timeout=60000)
+    page.wait_for_load_state("networkidle", timeout=60000)
+    page_hash = page_fingerprint(page)
+    if page_hash == known_hash:
+        log("No content change.")
+        return None, page_hash
+
+    # one round-trip for every card instead of 4 IPCs per item
+    rows = page.eval_on_selector_all(CARD_SELECTOR, _EXTRACT_JS)
+    names, prices = (list(col) for col in zip(*rows)) if rows else ([], [])
+    hashes = hash_rows(names, prices)  # raw 32-byte digests; hex only on CSV write
+    df = new_frame(names, prices, hashes)
+    log(f"Scraped {len(df)} items")
+    return df, page_hash
+
+def scrape_many(urls):
+    # one Chromium launch for all urls instead of one per page
     with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(URL, timeout=60000)
-        page.wait_for_load_state("networkidle", timeout=60000)
-
-        items = page.query_selector_all(".product-card")
-        data = []
-        for item in items:
-            name_el = item.query_selector(".product-name")
-            price_el = item.query_selector(".price")
-            name = name_el.inner_text().strip() if name_el else ""
-            price = price_el.inner_text().strip() if price_el else ""
-            hash_val = get_hash(name + "|" + price)
-            data.append({"name": name, "price": price, "hash": hash_val})
-        browser.close()
-        df = pd.DataFrame(data)
-        log(f"Scraped {len(df)} items")
-        return df
+        browser, context = open_context(p)
+        page = context.new_page()
+        try:
+            return [scrape_page(page, url)[0] for url in urls]
+        finally:
+            close_context(browser, context)
+
+def _hash64(hashes):
+    # first 8 bytes of each SHA-256 digest as uint64; collision-safe for N << 2**32 rows
+    return np.asarray(hashes, dtype="S32").view("<u8")[::4].copy()
+
+def new_frame(names, prices, hashes):
+    # parallel columns, not a list of row dicts: no per-row boxing on construction.
+    # hash stays raw bytes objects; an |S32 column would strip trailing NULs
+    cols = {"name": names, "price": prices, "hash": hashes, "hash64": _hash64(hashes)}
+    if ENGINE == "polars":
+        return pl.DataFrame(cols, schema=PL_SCHEMA)
+    return pd.DataFrame({c: pd.array(v, dtype=PD_SCHEMA[c]) for c, v in cols.items()})
+
+def empty_frame():
+    return new_frame([], [], [])
 
 def detect_deltas(df_new, df_old):
-    old_hashes = set(df_old["hash"].astype(str))
-    new_hashes = set(df_new["hash"].astype(str))
-    added_hashes = new_hashes - old_hashes
-    removed_hashes = old_hashes - new_hashes
-    added = df_new[df_new["hash"].isin(added_hashes)].copy()
-    removed = df_old[df_old["hash"].isin(removed_hashes)].copy()
+    # set ops run on the uint64 prefix; the full hash is kept for auditing
+    if ENGINE == "polars":
+        added = df_new.join(df_old.select("hash64"), on="hash64", how="anti")
+        removed = df_old.join(df_new.select("hash64"), on="hash64", how="anti")
+        return added, removed
+    new_arr = df_new["hash64"].to_numpy()
+    old_arr = df_old["hash64"].to_numpy()
+    # no assume_unique: two cards with the same name|price share a hash
+    added = df_new[~np.isin(new_arr, old_arr)].copy()
+    removed = df_old[~np.isin(old_arr, new_arr)].copy()
     return added, removed
 
-def upload_to_cloud(path: str, dest_name: str):
+def dump_frame(df, fmt, f):
+    # writes df to the binary file object f; feather/parquet keep hash as a binary column
+    if ENGINE == "polars":
+        if fmt == "feather":
+            df.write_ipc(f)
+        elif fmt == "parquet":
+            df.write_parquet(f, compression="zstd")
+        else:
+            df.drop("hash64").with_columns(pl.col("hash").bin.encode("hex")).write_csv(f)
+    elif fmt == "feather":
+        df.reset_index(drop=True).to_feather(f)
+    elif fmt == "parquet":
+        df.to_parquet(f, compression="zstd", index=False)
+    else:
+        df = df.drop(columns="hash64")
+        df.assign(hash=[h.hex() for h in df["hash"]]).to_csv(f, index=False, encoding="utf-8")
+
+def write_csv(df, path):
+    # 1 MiB block buffer: rows reach the OS in large writes, one flush on close
+    with open(path, "wb", buffering=1 << 20) as f:
+        dump_frame(df, "csv", f)
+
+def read_csv(path):
+    if ENGINE == "polars":
+        # empty fields read as null; match pandas' keep_default_na=False
+        df = pl.read_csv(path, infer_schema_length=0)
+        return df.with_columns(pl.col("name", "price").fill_null(""), pl.col("hash").str.decode("hex"))
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    df["hash"] = [bytes.fromhex(h) for h in df["hash"]]
+    return df
+
+def write_archive(df, path):
+    with open(path, "wb", buffering=1 << 20) as f:
+        dump_frame(df, ARCHIVE_FMT, f)
+
+def read_archive(path):
+    if ENGINE == "polars":
+        if path.endswith(".feather"):
+            df = pl.read_ipc(path)
+        elif path.endswith(".parquet"):
+            df = pl.read_parquet(path)
+        else:
+            df = read_csv(path)
+    elif path.endswith(".feather"):
+        df = pd.read_feather(path)
+    elif path.endswith(".parquet"):
+        df = pd.read_parquet(path, engine="pyarrow")
+    else:
+        df = read_csv(path)
+    # CSV exports and older snapshots carry only the full hash
+    if "hash64" not in df.columns:
+        df = new_frame(list(df["name"]), list(df["price"]), list(df["hash"]))
+    return df
+
+def find_prev_snapshot():
+    # fixed path, no directory scan; last_snapshot.csv is what runs before ARCHIVE_FMT wrote
+    for path in (SNAPSHOT_PATH, os.path.join(ARCHIVE_DIR, "last_snapshot.csv")):
+        if has_data(path):
+            return path
+    return None
+
+def replace_snapshot(df):
+    # write beside the old snapshot, then swap it in so readers never see a partial file
+    tmp = SNAPSHOT_PATH + ".tmp"
+    write_archive(df, tmp)
+    os.replace(tmp, SNAPSHOT_PATH)
+
+def upload_to_cloud(source, dest_name: str):
+    # source is a local path, or a (dataframe, fmt) tuple serialized straight to memory.
+    # Frames are serialized again here rather than re-read from the archive file: this
+    # trades a second encode (on the upload thread) for not touching the disk
+    buf = None
+    if UPLOAD_TO in ("s3", "gcs") and isinstance(source, tuple):
+        buf = io.BytesIO()
+        dump_frame(*source, buf)
+        buf.seek(0)
     if UPLOAD_TO == "s3":
         import boto3
-        s3 = boto3.client("s3")
-        s3.upload_file(path, BUCKET_NAME, dest_name)
+        from boto3.s3.transfer import TransferConfig
+        s3 = boto3.session.Session().client("s3")  # own session: called from worker threads
+        config = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                                max_concurrency=4, use_threads=True)
+        if buf is not None:
+            s3.upload_fileobj(buf, BUCKET_NAME, dest_name, Config=config)
+        else:
+            s3.upload_file(source, BUCKET_NAME, dest_name, Config=config)
         log(f"Uploaded to s3://{BUCKET_NAME}/{dest_name}")
     elif UPLOAD_TO == "gcs":
         from google.cloud import storage
         client = storage.Client()
         bucket = client.bucket(BUCKET_NAME)
         blob = bucket.blob(dest_name)
-        blob.upload_from_filename(path)
+        if buf is not None:
+            # known size lets GCS do a single-request upload instead of a resumable session
+            blob.upload_from_file(buf, size=buf.getbuffer().nbytes, timeout=60, checksum=None)
+        else:
+            blob.upload_from_filename(source, timeout=60, checksum=None)
         log(f"Uploaded to gs://{BUCKET_NAME}/{dest_name}")
     else:
         log(f"Skipped upload (UPLOAD_TO={UPLOAD_TO})")
 
-def main():
-    df_new = scrape_page()
+def upload_all(jobs):
+    # jobs are (source, dest_name) pairs uploaded concurrently; failed ones are retried
+    # and, if they still fail, all of them are reported together
+    for attempt in range(1 + UPLOAD_RETRIES):
+        if attempt:
+            time.sleep(2 ** attempt)  # back off 2 s, 4 s, ... so transient outages can clear
+        futures = {_uploads.submit(upload_to_cloud, *job): job for job in jobs}
+        failed = []
+        for f in as_completed(futures):
+            try:
+                f.result()
+            except Exception as e:
+                log(f"Upload of {futures[f][1]} failed: {e}")
+                failed.append((futures[f], e))
+        if not failed:
+            return
+        jobs = [job for job, _ in failed]
+    raise RuntimeError("upload failed: " + "; ".join(f"{job[1]}: {e}" for job, e in failed))
+
+def run(page, force_snapshot=False):
+    global _df_prev
+    prev_path = find_prev_snapshot()
+
+    # Unchanged page since the archived snapshot: nothing to extract, diff or upload
+    has_prev = not force_snapshot and (_df_prev is not None or prev_path is not None)
+    df_new, page_hash = scrape_page(page, known_hash=read_page_hash() if has_prev else None)
+    if df_new is None:
+        if prev_path is not None:
+            os.utime(prev_path, None)  # still current: keep its timestamp fresh
+        log("Completed run.")
+        return
     timestamp = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    df_new.to_csv(LATEST_PATH, index=False)
-    log(f"Saved latest snapshot: {LATEST_PATH}")
 
-    # Load previous if exists
-    prev_path = os.path.join(ARCHIVE_DIR, "last_snapshot.csv")
-    if os.path.exists(prev_path):
-        df_old = pd.read_csv(prev_path)
+    # Previous frame from memory; on cold start load it from disk
+    if _df_prev is not None:
+        df_old = _df_prev
+    elif prev_path is not None:
+        df_old = read_archive(prev_path)
     else:
-        df_old = pd.DataFrame(columns=df_new.columns)
+        df_old = empty_frame()
 
     added, removed = detect_deltas(df_new, df_old)
-    if not added.empty or not removed.empty:
-        added_path = os.path.join(ARCHIVE_DIR, f"added_{timestamp}.csv")
-        removed_path = os.path.join(ARCHIVE_DIR, f"removed_{timestamp}.csv")
-        if not added.empty:
-            added.to_csv(added_path, index=False)
-            upload_to_cloud(added_path, f"added_{timestamp}.csv")
-        if not removed.empty:
-            removed.to_csv(removed_path, index=False)
-            upload_to_cloud(removed_path, f"removed_{timestamp}.csv")
-        log("Changes detected and uploaded.")
+    changed = bool(len(added) or len(removed))
+    uploads = []
+    if changed:
+        added_path = os.path.join(ARCHIVE_DIR, f"added_{timestamp}{ARCHIVE_EXT}")
+        removed_path = os.path.join(ARCHIVE_DIR, f"removed_{timestamp}{ARCHIVE_EXT}")
+        if len(added):
+            write_archive(added, added_path)
+            uploads.append(((added, ARCHIVE_FMT), f"added_{timestamp}{ARCHIVE_EXT}"))
+        if len(removed):
+            write_archive(removed, removed_path)
+            uploads.append(((removed, ARCHIVE_FMT), f"removed_{timestamp}{ARCHIVE_EXT}"))
+    new_snapshot = changed or prev_path is None or force_snapshot
+    if new_snapshot:
+        uploads.append(((df_new, ARCHIVE_FMT), f"snapshot_{timestamp}{ARCHIVE_EXT}"))
+
+    # The snapshot and page hash only advance once every upload succeeded, so a
+    # failed run is diffed and uploaded again next time
+    upload_all(uploads)
+    log("Changes detected and uploaded." if changed else "No changes detected.")
+
+    # Save new snapshot for next run; an unchanged one only gets its mtime refreshed
+    if new_snapshot:
+        snap_path = SNAPSHOT_PATH
+        replace_snapshot(df_new)
     else:
-        log("No changes detected.")
+        snap_path = None
+        os.utime(prev_path, None)
+        log(f"Kept previous snapshot: {prev_path}")
+    with open(PAGE_HASH_PATH, "wb") as f:
+        f.write(page_hash)
+    _df_prev = df_new
 
-    # Save new snapshot for next run
-    df_new.to_csv(prev_path, index=False)
-    upload_to_cloud(prev_path, f"snapshot_{timestamp}.csv")
+    # CSV export for downstream consumers only; never read back
+    if ARCHIVE_FMT == "csv" and snap_path is not None:
+        shutil.copyfile(snap_path, LATEST_PATH)  # same bytes, skip reserializing
+    else:
+        write_csv(df_new, LATEST_PATH)
+    log(f"Saved latest snapshot: {LATEST_PATH}")
     log("Completed run.")
 
+def _reply(conn, msg):
+    # the client may already have hung up; that must not take the daemon down
+    try:
+        conn.sendall(msg.encode("utf-8"))
+    except OSError as e:
+        log(f"Could not reply to client: {e}")
+
+def serve(page, socket_path=SOCKET_PATH, force_snapshot=False):
+    # any message triggers a run on the already-open page; "stop" shuts down
+    try:
+        os.unlink(socket_path)  # stale socket from a previous daemon
+    except FileNotFoundError:
+        pass
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as srv:
+        srv.bind(socket_path)
+        srv.listen()
+        log(f"Daemon listening on {socket_path}")
+        try:
+            while True:
+                conn, _ = srv.accept()
+                with conn:
+                    conn.settimeout(5)  # a silent client can't block the accept loop
+                    try:
+                        msg = conn.recv(64).strip()
+                    except OSError as e:
+                        log(f"Dropped client: {e}")
+                        continue
+                    if msg == b"stop":
+                        _reply(conn, "bye\n")
+                        break
+                    try:
+                        run(page, force_snapshot=force_snapshot)
+                    except Exception as e:
+                        log(f"ERROR: {e}")
+                        _reply(conn, f"error: {e}\n")
+                    else:
+                        _reply(conn, "ok\n")
+        finally:
+            os.unlink(socket_path)
+
+def main(argv=None):
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Scrape products and archive deltas.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep Chromium alive and run once per message on --socket")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="unix socket path for --daemon")
+    parser.add_argument("--force-snapshot", action="store_true",
+                        help="write and upload a snapshot even when nothing changed")
+    args = parser.parse_args(argv)
+
+    with sync_playwright() as p:
+        browser, context = open_context(p)
+        try:
+            page = context.new_page()
+            if args.daemon:
+                serve(page, args.socket, force_snapshot=args.force_snapshot)
+            else:
+                run(page, force_snapshot=args.force_snapshot)
+        finally:
+            # one-shot runs throw the cookies away anyway; only a daemon keeps them
+            close_context(browser, context, save_state=args.daemon)
+
 if __name__ == "__main__":
     try:
         main()